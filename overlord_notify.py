@@ -3,15 +3,21 @@
 import sqlite3
 import json
 import logging
-import os.path
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from functools import lru_cache
 from logging import handlers
-from smtplib import SMTP_SSL, SMTPAuthenticationError
-from typing import Text, Optional, List
+from pathlib import Path
+from smtplib import SMTP_SSL, SMTPAuthenticationError, SMTPServerDisconnected
+from typing import Text, Optional, List, Tuple
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+
+_HERE = Path(__file__).resolve().parent
 
 
 class TranslationItem:
@@ -21,7 +27,7 @@ class TranslationItem:
         self.status = status
         self.db_manager = db_manager
 
-        self.logger = prepare_logger(f'{self.title.lower()}#{self.volume}')
+        self.logger = logging.LoggerAdapter(_MODULE_LOGGER, {'item': f'{self.title.lower()}#{self.volume}'})
 
     def __repr__(self):
         return f'{self.title}#{self.volume}:"{self.status}"'
@@ -48,19 +54,14 @@ class TranslationItem:
             return False
         else:
             self.logger.info("status has been updated")
-            self.db_manager.add_new_status(self)
             return True
 
-    def send_notification(self, receiver_email) -> bool:
+    def send_notification(self, receiver_email, mail_server: 'MailServer') -> bool:
         self.logger.info(f"sending notification email to {receiver_email}")
-        sender_email, app_password, server_address = read_credentials()
 
         try:
-            server = SMTP_SSL(server_address)
-            server.login(sender_email, app_password)
-            server.send_message(self.create_message(sender_email, receiver_email))
-            server.quit()
-            self.logger.info(f"email successfully sent to {receiver_email} from {sender_email}")
+            mail_server.send_message(self.create_message(mail_server.sender_email, receiver_email))
+            self.logger.info(f"email successfully sent to {receiver_email} from {mail_server.sender_email}")
             self.db_manager.update_notification_status(self)
             return True
         except SMTPAuthenticationError:
@@ -71,73 +72,144 @@ class TranslationItem:
             return False
 
 
+class MailServer:
+    def __init__(self):
+        self.server: Optional[SMTP_SSL] = None
+
+    @property
+    def sender_email(self) -> Text:
+        return read_credentials()[0]
+
+    def connect(self):
+        sender_email, app_password, server_address = read_credentials()
+        server = SMTP_SSL(server_address)
+        try:
+            server.login(sender_email, app_password)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+
+    def send_message(self, msg: EmailMessage):
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.send_message(msg)
+        except SMTPServerDisconnected:
+            self.server = None
+            self.connect()
+            self.server.send_message(msg)
+
+    def quit(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except SMTPServerDisconnected:
+                pass
+            self.server = None
+
+
 class DatabaseManager:
     db_name = 'notify_db.sqlite'
     table_name = 'items'
+    pages_table_name = 'pages'
+
+    _SQL_CREATE_ITEMS = (
+        f"CREATE TABLE IF NOT EXISTS {table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, "
+        f"volume INTEGER, status TEXT, date DATE DEFAULT CURRENT_DATE, is_notified BOOL DEFAULT FALSE);"
+    )
+    _SQL_CREATE_ITEMS_INDEX = (
+        f"CREATE INDEX IF NOT EXISTS idx_{table_name}_title_vol_id ON {table_name} (title, volume, id DESC);"
+    )
+    _SQL_CREATE_PAGES = (
+        f"CREATE TABLE IF NOT EXISTS {pages_table_name} (url TEXT, title TEXT, etag TEXT, last_modified TEXT, "
+        f"PRIMARY KEY (url, title));"
+    )
+    _SQL_GET_LAST = f"SELECT status FROM {table_name} WHERE title = ? AND volume = ? ORDER BY id DESC LIMIT 1;"
+    _SQL_INSERT = f"INSERT INTO {table_name} (title, volume, status) VALUES (?, ?, ?);"
+    _SQL_UPDATE_NOTIFIED = f"UPDATE {table_name} SET is_notified = TRUE WHERE title = ? AND volume = ? AND status = ?;"
+    _SQL_GET_UNSENT = f"SELECT title, volume, status FROM {table_name} WHERE is_notified = FALSE;"
+    _SQL_GET_VALIDATORS = f"SELECT etag, last_modified FROM {pages_table_name} WHERE url = ? AND title = ?;"
+    _SQL_SAVE_VALIDATORS = (
+        f"INSERT OR REPLACE INTO {pages_table_name} (url, title, etag, last_modified) VALUES (?, ?, ?, ?);"
+    )
 
     def __init__(self):
-        self.logger = prepare_logger('db', log_level='DEBUG')
+        self.logger = logging.LoggerAdapter(_MODULE_LOGGER, {'item': 'db'})
+        self.lock = threading.Lock()
+        self.connection = None
         try:
-            self.connection = sqlite3.connect(self.db_name)
+            self.connection = sqlite3.connect(self.db_name, check_same_thread=False)
             self.logger.debug(f"connected to database {self.db_name}")
-            self.connection.execute(
-                f"CREATE TABLE IF NOT EXISTS {self.table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, "
-                f"volume INTEGER, status TEXT, date DATE DEFAULT CURRENT_DATE, is_notified BOOL DEFAULT FALSE);"
-            )
+            self.connection.execute("PRAGMA journal_mode=WAL;")
+            self.connection.execute("PRAGMA synchronous=NORMAL;")
+            self.connection.execute("PRAGMA temp_store=MEMORY;")
+            self.connection.execute("PRAGMA mmap_size=67108864;")
+            self.connection.execute(self._SQL_CREATE_ITEMS)
+            self.connection.execute(self._SQL_CREATE_ITEMS_INDEX)
+            self.connection.execute(self._SQL_CREATE_PAGES)
         except sqlite3.Error as error:
             self.logger.critical("error occurred - " + str(error))
             self.close()
 
-    def __del__(self):
-        self.close()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self.connection:
+                self.connection.commit()
+                self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        finally:
+            self.close()
 
     def close(self):
         if self.connection:
             self.connection.close()
+            self.connection = None
             self.logger.debug(f"connection to the database {self.db_name} has been closed")
 
     def get_last_status(self, item: TranslationItem) -> Optional[Text]:
         self.logger.debug(f"request for last status for {str(item)}")
-        cursor = self.connection.cursor()
-        cursor.execute(f"SELECT status FROM {self.table_name} WHERE title = ? AND volume = ? ORDER BY id DESC LIMIT 1;",
-                       (item.title, item.volume))
-        results = cursor.fetchall()
-        cursor.close()
-        return results[0][0] if results else None
-
-    def add_new_status(self, item: TranslationItem):
-        self.logger.debug(f"request to add {str(item)}")
-        cursor = self.connection.cursor()
-        cursor.execute(f"INSERT INTO {self.table_name} (title, volume, status) VALUES (?, ?, ?);",
-                       (item.title, item.volume, item.status))
-        cursor.close()
-        self.connection.commit()
+        row = self.connection.execute(self._SQL_GET_LAST, (item.title, item.volume)).fetchone()
+        return row[0] if row else None
+
+    def add_new_statuses(self, rows: List[tuple]):
+        self.logger.debug(f"request to add {len(rows)} new statuses")
+        with self.lock, self.connection:
+            self.connection.executemany(self._SQL_INSERT, rows)
 
     def update_notification_status(self, item: TranslationItem):
         self.logger.debug(f"request to update notification status for {str(item)}")
-        cursor = self.connection.cursor()
-        cursor.execute(f"UPDATE {self.table_name} SET is_notified = TRUE "
-                       f"WHERE title = ? AND volume = ? AND status = ?;", (item.title, item.volume, item.status))
-        cursor.close()
-        self.connection.commit()
+        with self.lock:
+            self.connection.execute(self._SQL_UPDATE_NOTIFIED, (item.title, item.volume, item.status))
+            self.connection.commit()
+
+    def get_page_validators(self, url: Text, title: Text) -> Tuple[Optional[Text], Optional[Text]]:
+        self.logger.debug(f"request for cache validators of {url} for {title}")
+        row = self.connection.execute(self._SQL_GET_VALIDATORS, (url, title)).fetchone()
+        return row if row else (None, None)
+
+    def save_page_validators(self, url: Text, title: Text, etag: Optional[Text], last_modified: Optional[Text]):
+        self.logger.debug(f"request to save cache validators of {url} for {title}")
+        with self.lock, self.connection:
+            self.connection.execute(self._SQL_SAVE_VALIDATORS, (url, title, etag, last_modified))
 
     def items_with_unsent_notification(self) -> List:
         self.logger.debug(f"request to find all missing notifications")
-        cursor = self.connection.cursor()
-        cursor.execute(f"SELECT title, volume, status FROM items WHERE is_notified = FALSE;")
-        results = cursor.fetchall()
-        cursor.close()
-        return results
+        return self.connection.execute(self._SQL_GET_UNSENT).fetchall()
 
 
 def prepare_logger(logger_name: str, log_file: str = 'notify.log', log_level: str = 'INFO') -> logging.Logger:
     logger = logging.getLogger(logger_name)
     logger.setLevel(log_level)
-    formatter = logging.Formatter(fmt='%(asctime)s - %(name)s:%(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    formatter = logging.Formatter(fmt='%(asctime)s - %(item)s:%(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                                  defaults={'item': logger_name})
 
-    # FILE handler
-    handler = handlers.WatchedFileHandler(os.path.join(os.path.dirname(__file__), log_file))
-    handler.setFormatter(formatter)
+    # FILE handler, buffered in memory and flushed on errors or at exit by logging.shutdown()
+    file_handler = handlers.WatchedFileHandler(_HERE / log_file)
+    file_handler.setFormatter(formatter)
+    handler = handlers.MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=file_handler)
     logger.addHandler(handler)
 
     # STDOUT handler
@@ -149,30 +221,89 @@ def prepare_logger(logger_name: str, log_file: str = 'notify.log', log_level: st
     return logger
 
 
+_MODULE_LOGGER = logging.getLogger('notify')
+
+
+@lru_cache(maxsize=1)
 def read_credentials():
-    file_path = os.path.join(os.path.dirname(__file__), 'credentials.json')
-    with open(file_path, 'r') as f:
+    with open(_HERE / 'credentials.json', 'r') as f:
         credentials = json.load(f)
         return credentials['email'], credentials['app_password'], credentials['server']
 
 
-def find_item(title, url, receiver_email):
-    header = {"UserAgent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:86.0) Gecko/20100101 Firefox/86.0'}
-    page = requests.get(url, headers=header)
-    soup = BeautifulSoup(page.content, 'html.parser')
+def send_missing_notifications(db_manager: DatabaseManager, receiver_email, max_workers: int = 8) -> List[bool]:
+    # SMTP sessions are stateful, so every worker thread gets its own connection
+    local = threading.local()
+    mail_servers = []
+
+    def send(missing_item) -> bool:
+        if not hasattr(local, 'mail_server'):
+            local.mail_server = MailServer()
+            mail_servers.append(local.mail_server)
+        item = TranslationItem(*missing_item, db_manager=db_manager)
+        return item.send_notification(receiver_email, local.mail_server)
 
-    items = soup.find('div', class_='post-content').findAll('td')
-    items = [item.get_text() for item in items if title in item.get_text()]
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(send, db_manager.items_with_unsent_notification()))
+    finally:
+        for mail_server in mail_servers:
+            mail_server.quit()
 
-    db_manager = DatabaseManager()
-    for missing_item in db_manager.items_with_unsent_notification():
-        TranslationItem(*missing_item, db_manager=db_manager).send_notification(receiver_email)
 
-    for item in items:
-        item, status = [elem.strip() for elem in item.split('–')]
-        item = TranslationItem(title, item.split('#')[-1], status, db_manager)
-        if item.check_for_updates():
-            item.send_notification(receiver_email)
+SESSION = requests.Session()
+SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:86.0) Gecko/20100101 Firefox/86.0',
+    'Accept-Encoding': 'gzip, deflate',
+})
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
 
 
-find_item('Overlord', 'https://kotori.pl/zapowiedzi/', '')
+def find_item(title, url, receiver_email):
+    with DatabaseManager() as db_manager:
+        send_missing_notifications(db_manager, receiver_email)
+
+        etag, last_modified = db_manager.get_page_validators(url, title)
+        conditional_headers = {}
+        if etag:
+            conditional_headers['If-None-Match'] = etag
+        if last_modified:
+            conditional_headers['If-Modified-Since'] = last_modified
+
+        page = SESSION.get(url, headers=conditional_headers)
+        if page.status_code == 304:
+            _MODULE_LOGGER.info(f"{url} has not changed since the last check for {title}")
+            return
+        page.raise_for_status()
+
+        soup = BeautifulSoup(page.content, 'lxml', parse_only=SoupStrainer('div', class_='post-content'))
+        quoted_title = title.replace('\\', '\\\\').replace('"', '\\"')
+        items = [item.get_text() for item in soup.select(f'div.post-content td:-soup-contains("{quoted_title}")')]
+
+        changed_items = {}
+        for item in items:
+            item, separator, status = item.partition('–')
+            if not separator:
+                _MODULE_LOGGER.warning(f"skipping row without a status: {item.strip()!r}")
+                continue
+            item = TranslationItem(title, item.strip().rpartition('#')[2], status.strip(), db_manager)
+            if (item.title, item.volume) not in changed_items and item.check_for_updates():
+                changed_items[(item.title, item.volume)] = item
+        updated_items = list(changed_items.values())
+        if updated_items:
+            db_manager.add_new_statuses([(item.title, item.volume, item.status) for item in updated_items])
+        if page.status_code == 200:
+            db_manager.save_page_validators(url, title, page.headers.get('ETag'), page.headers.get('Last-Modified'))
+
+        if updated_items:
+            mail_server = MailServer()
+            try:
+                for item in updated_items:
+                    item.send_notification(receiver_email, mail_server)
+            finally:
+                mail_server.quit()
+
+
+if __name__ == "__main__":
+    prepare_logger(_MODULE_LOGGER.name, log_level='DEBUG')
+    find_item('Overlord', 'https://kotori.pl/zapowiedzi/', '')